@@ -0,0 +1,11 @@
+# Gunicorn settings for serving main:app on Linux/macOS:  gunicorn -c gunicorn.conf.py main:app
+# gevent workers park a greenlet, not an OS thread, while a chat waits on OpenAI (httpx sockets are patched).
+import os
+
+bind = os.getenv("BIND", "127.0.0.1:5000")
+worker_class = "gevent"
+# one worker by default: the profile and reply caches live in-process, and a single
+# gevent worker already overlaps hundreds of OpenAI waits
+workers = int(os.getenv("WEB_CONCURRENCY", "1"))
+worker_connections = int(os.getenv("WORKER_CONNECTIONS", "500"))
+keepalive = 5
@@ -1,40 +1,129 @@
 # main.py
 # Desktop Chatbot backend — Flask + SQLite + OpenAI
 
-from flask import Flask, request, jsonify, render_template
+from flask import Flask, Request, Response, request, jsonify, render_template
+from flask.json.provider import JSONProvider, DefaultJSONProvider
 from flask_cors import CORS
-from sqlalchemy import create_engine, Column, Integer, String, Text, ForeignKey, DateTime
-from sqlalchemy.orm import sessionmaker, declarative_base, relationship
+from sqlalchemy import create_engine, event, inspect, select, lambda_stmt, insert, delete, text as sql_text, Column, Index, Integer, String, Text, ForeignKey, DateTime, Boolean
+from sqlalchemy.orm import sessionmaker, scoped_session, declarative_base, relationship
 from datetime import datetime
+from functools import lru_cache
+from itertools import islice
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
-from openai import OpenAI
+from openai import OpenAI, DefaultHttpxClient, DEFAULT_TIMEOUT
+from importlib.util import find_spec
 from werkzeug.utils import secure_filename
-import os, uuid, base64
+import os, io, uuid, base64, time, hashlib, tempfile, queue, threading
+import orjson
+import httpx
 
 # --- Setup --------------------------------------------------------------
 load_dotenv()
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
 OPENAI_MODEL   = os.getenv("OPENAI_MODEL", "gpt-5-mini") 
+OPENAI_TIMEOUT = float(os.getenv("OPENAI_TIMEOUT", DEFAULT_TIMEOUT.read))   # read timeout, seconds; SDK default 600
+MAX_HISTORY_MESSAGES = int(os.getenv("MAX_HISTORY_MESSAGES", "20"))   # turns sent per request, incl. the new one
+MAX_HISTORY_TOKENS = int(os.getenv("MAX_HISTORY_TOKENS", "4000"))       # budget for the stored turns in that window
 assert OPENAI_API_KEY, "OPENAI_API_KEY is missing in .env"
 
-client = OpenAI(api_key=OPENAI_API_KEY)
+OPENAI_MAX_CONNECTIONS = int(os.getenv("OPENAI_MAX_CONNECTIONS", "100"))
+
+# one shared client: its httpx pool is thread-safe and reused across requests.
+# keep-alive skips a TLS handshake per call; HTTP/2 (needs h2) multiplexes concurrent chats on one connection
+http_client = DefaultHttpxClient(
+    http2=find_spec("h2") is not None,
+    limits=httpx.Limits(max_connections=OPENAI_MAX_CONNECTIONS, max_keepalive_connections=OPENAI_MAX_CONNECTIONS),
+)
+# the SDK's default timeouts (connect 5s, 600s otherwise); OPENAI_TIMEOUT only replaces the 600s
+client = OpenAI(api_key=OPENAI_API_KEY, timeout=httpx.Timeout(OPENAI_TIMEOUT, connect=DEFAULT_TIMEOUT.connect),
+                http_client=http_client)
+
+class OrjsonProvider(JSONProvider):
+    """orjson for request bodies and jsonify(); serializes datetimes natively."""
+    # types orjson lacks (Decimal, UUID, __html__ ...) fall back to Flask's own conversions
+    default = staticmethod(DefaultJSONProvider.default)
+
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj, default=self.default).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+    def response(self, *args, **kwargs):
+        # hand orjson's bytes to the response as-is: no str round trip per response
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(orjson.dumps(obj, default=self.default), mimetype="application/json")
 
 app = Flask(__name__)
+app.json = OrjsonProvider(app)
 CORS(app)
 
 # uploads
 UPLOAD_DIR = os.path.join(os.path.dirname(__file__), "uploads")
 os.makedirs(UPLOAD_DIR, exist_ok=True)
+app.config["MAX_CONTENT_LENGTH"] = int(os.getenv("MAX_UPLOAD_MB", "50")) * 1024 * 1024
+
+class UploadRequest(Request):
+    """Spools multipart file parts straight into UPLOAD_DIR while the body is parsed."""
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        part = tempfile.NamedTemporaryFile(dir=UPLOAD_DIR, suffix=".part", delete=False)
+        self.__dict__.setdefault("upload_parts", []).append(part.name)
+        return part
+
+    def close(self):
+        super().close()
+        for path in self.__dict__.get("upload_parts", ()):
+            if os.path.exists(path):   # not moved into place by save_upload()
+                os.remove(path)
+
+app.request_class = UploadRequest
 
 TEXT_MIME_PREFIXES = ("text/",)
 DOC_MIME = ("application/msword", "application/vnd.openxmlformats-officedocument.wordprocessingml.document")
 PDF_MIME = ("application/pdf",)
 CSV_MIME = ("text/csv", "application/vnd.ms-excel", "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet")
+IMAGE_CACHE_SIZE = 8   # data URLs kept in memory, keyed by blob path (= content hash)
+IMAGE_CACHE_MAX_BYTES = 2 * 1024 * 1024   # larger images are re-encoded per turn: cache tops out near 22 MB
+
+# constant part of the system prompt; only the profile note varies per request
+SYSTEM_PROMPT_PREFIX = (
+    "You are a mentor-style assistant. Use Greek for prose and keep technical terms in English. "
+    "Write with clear structure using Markdown. Default to short paragraphs with whitespace. "
+    "Use bullet lists when enumerating, tables for comparisons when helpful, and fenced code blocks with language. "
+    "Prefer clarity over verbosity; add small headings if it aids scanning. "
+    "Preserve privacy; avoid storing sensitive data. "
+    "If you are not sure about something ask for more information."
+    "If the mini model that we use is not capable to solve or explain a problem you should tell me to switch to a more skillful model."
+    "Explain like you talk to human with explanations not just theory."
+    "Try to put a tone of humor in your responses."
+    "Try to notice best practices✅, acceptable but not the perfect thing⚠️, and avoid to do❌."
+    "Use emojis for more fun conversations."
+    "Keep answers within 3–5 short paragraphs unless explicitly asked for more."
+)
 
 # --- DB -----------------------------------------------------------------
 DB_URL = "sqlite:///chatbot.db"
-engine = create_engine(DB_URL, echo=False, future=True)
+# SQLAlchemy 2.0 pools file-based SQLite with a QueuePool; connections may move between threads.
+# Sized for the threaded server plus the chat workers, which each hold a connection while saving;
+# connections are released before OpenAI calls, so gevent workers need far fewer than worker_connections.
+engine = create_engine(DB_URL, future=True,
+                       pool_size=int(os.getenv("DB_POOL_SIZE", "10")), max_overflow=int(os.getenv("DB_MAX_OVERFLOW", "20")),
+                       connect_args={"check_same_thread": False})
+
+@event.listens_for(engine, "connect")
+def set_sqlite_pragmas(dbapi_conn, _record):
+    # WAL: readers don't block the writer; NORMAL: no fsync per commit (still crash-safe in WAL)
+    cur = dbapi_conn.cursor()
+    cur.execute("PRAGMA journal_mode=WAL")
+    cur.execute("PRAGMA synchronous=NORMAL")
+    cur.execute("PRAGMA cache_size=-20000")      # ~20 MB page cache
+    cur.execute("PRAGMA temp_store=MEMORY")
+    cur.execute("PRAGMA mmap_size=268435456")    # 256 MB
+    cur.close()
+
 SessionLocal = sessionmaker(bind=engine, autoflush=False)
+db = scoped_session(SessionLocal)   # one session per request thread, removed on teardown
 Base = declarative_base()
 
 # --- Models -------------------------------------------------------------
@@ -50,12 +139,15 @@ class Conversation(Base):
     __tablename__ = "conversations"
     id = Column(Integer, primary_key=True)
     title = Column(String(200), default="New Conversation")
+    title_set = Column(Boolean, nullable=False, default=False, server_default=sql_text("0"))   # auto-titled after turn 1
     created_at = Column(DateTime, default=datetime.utcnow)
-    updated_at = Column(DateTime, default=datetime.utcnow)
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow, index=True)   # list ORDER BY
     messages = relationship("Message", back_populates="conversation", cascade="all, delete-orphan")
 
 class Message(Base):
     __tablename__ = "messages"
+    # WHERE conversation_id = ? ORDER BY id is a range scan on this index, no sort step
+    __table_args__ = (Index("ix_msg_conv_id", "conversation_id", "id"),)
     id = Column(Integer, primary_key=True)
     conversation_id = Column(Integer, ForeignKey("conversations.id"), nullable=False)
     role = Column(String(20), nullable=False)      # 'user' | 'assistant' | 'system'
@@ -66,33 +158,135 @@ class Message(Base):
 class Attachment(Base):
     __tablename__ = "attachments"
     id = Column(Integer, primary_key=True)
-    conversation_id = Column(Integer, ForeignKey("conversations.id"), nullable=False)
+    conversation_id = Column(Integer, ForeignKey("conversations.id"), nullable=False, index=True)
     filename = Column(String(300), nullable=False)
     mime = Column(String(120), nullable=True)
     path = Column(String(500), nullable=False)
     size = Column(Integer, nullable=False)
+    sha256 = Column(String(64), nullable=True, index=True)   # content hash; identical files share one blob
+    preview_text = Column(Text, nullable=True)     # extracted at upload; NULL for images
     created_at = Column(DateTime, default=datetime.utcnow)
-
-Base.metadata.create_all(engine)
+    conversation = relationship("Conversation")
+
+OBSOLETE_INDEXES = ("ix_messages_conversation_id",)   # superseded by ix_msg_conv_id
+COLUMN_BACKFILLS = {   # run once, right after the column is added to an existing DB
+    ("conversations", "title_set"): "UPDATE conversations SET title_set = 1 WHERE title != 'New Conversation'",
+}
+
+def migrate_db():
+    # create_all() only creates missing tables: add columns/indexes introduced later to existing DBs
+    insp = inspect(engine)
+    with engine.begin() as conn:
+        for table in Base.metadata.sorted_tables:
+            existing = {c["name"] for c in insp.get_columns(table.name)}
+            for col in table.columns:
+                if col.name not in existing:
+                    ddl = col.type.compile(dialect=engine.dialect)
+                    if col.server_default is not None:   # SQLite needs a DEFAULT to add a NOT NULL column
+                        ddl += ("" if col.nullable else " NOT NULL") + f" DEFAULT {col.server_default.arg.text}"
+                    conn.execute(sql_text(f"ALTER TABLE {table.name} ADD COLUMN {col.name} {ddl}"))
+                    backfill = COLUMN_BACKFILLS.get((table.name, col.name))
+                    if backfill:
+                        conn.execute(sql_text(backfill))
+            for idx in table.indexes:
+                idx.create(conn, checkfirst=True)
+        for name in OBSOLETE_INDEXES:
+            conn.execute(sql_text(f"DROP INDEX IF EXISTS {name}"))
+
+def init_db():
+    Base.metadata.create_all(engine)
+    migrate_db()
+
+@app.cli.command("init-db")
+def init_db_command():
+    """Create/migrate the schema once, before starting server workers."""
+    init_db()
+    print("Database initialized.")
+
+# served deployments run `flask --app main init-db` once instead of every worker doing it at import
+if os.getenv("INIT_DB"):
+    init_db()
 
 # --- Helpers ------------------------------------------------------------
-def get_session():
-    return SessionLocal()
+@app.teardown_appcontext
+def remove_session(exc=None):
+    db.remove()   # close the request's session and return its connection to the pool
+
+profile_ref = {"id": None}   # PK of the singleton profile row, remembered after the first lookup
+profile_cache = {"v": None}  # its fields as a dict; reset on PUT/DELETE
+
+def cached_profile():
+    # single-user app: reads never hit the DB until the profile changes
+    if profile_cache["v"] is None:
+        prof = ensure_profile()
+        profile_cache["v"] = {"id": prof.id, "name": prof.name, "timezone": prof.timezone, "tone": prof.tone, "notes": prof.notes}
+    return profile_cache["v"]
+
+def load_profile():
+    # db is the thread's scoped session: same one the calling view uses
+    pid = profile_ref["id"]
+    prof = db.get(UserProfile, pid) if pid is not None else None   # identity map, else PK lookup
+    if prof is None:
+        prof = db.query(UserProfile).first()
+    profile_ref["id"] = prof.id if prof else None
+    return prof
 
-def ensure_profile(session):
-    prof = session.query(UserProfile).first()
+def ensure_profile():
+    prof = load_profile()
     if not prof:
         prof = UserProfile(name=None, timezone="Europe/Athens", tone="professional", notes=None)
-        session.add(prof)
-        session.commit()
+        db.add(prof)
+        db.commit()
     return prof
 
-def title_from_first_user_message(history):
-    for m in history:
-        if m["role"] == "user":
-            text = (m["content"] if isinstance(m["content"], str) else "").strip().splitlines()[0]
-            return (text[:40] + "…") if len(text) > 40 else text
-    return "New Conversation"
+def profile_note(name, timezone, tone, notes):
+    note = f"User name: {name or 'User'}. Timezone: {timezone or 'Europe/Athens'}. Tone: {tone or 'professional'}."
+    return f"{note} Extra notes: {notes[:300]}" if notes else note
+
+@lru_cache(maxsize=8)
+def system_message(name, timezone, tone, notes):
+    # built once per distinct profile and shared read-only by every request
+    return {"role": "system", "content": SYSTEM_PROMPT_PREFIX + profile_note(name, timezone, tone, notes)}
+
+def sse_event(payload):
+    return f"data: {orjson.dumps(payload).decode()}\n\n"
+
+token_encoder_ref = {"enc": None}   # tiktoken encoding once loaded; until then counts are estimated
+
+def load_token_encoder():
+    # may download the BPE file (no timeout): runs once at startup, never inside a request
+    try:
+        import tiktoken
+        try:
+            enc = tiktoken.encoding_for_model(OPENAI_MODEL)
+        except KeyError:
+            enc = tiktoken.get_encoding("o200k_base")   # model unknown to this tiktoken version
+    except Exception:
+        return
+    token_encoder_ref["enc"] = enc
+
+threading.Thread(target=load_token_encoder, name="tiktoken", daemon=True).start()
+
+def count_tokens(text):
+    enc = token_encoder_ref["enc"]
+    return len(enc.encode(text, disallowed_special=())) if enc else len(text) // 4 + 1
+
+def trim_history(history, budget):
+    """Keeps the newest messages that fit in `budget` tokens; older ones are dropped."""
+    kept, used = [], 0
+    for m in reversed(history):
+        used += count_tokens(m["content"]) + 4   # + per-message framing
+        if used > budget:
+            break
+        kept.append(m)
+    kept.reverse()
+    return kept
+
+def title_from_text(text):
+    lines = (text or "").strip().splitlines()
+    if not lines:
+        return "New Conversation"
+    return (lines[0][:40] + "…") if len(lines[0]) > 40 else lines[0]
 
 def read_text_file(path, max_chars=8000):
     try:
@@ -103,23 +297,24 @@ def read_text_file(path, max_chars=8000):
 
 def read_csv_preview(path, max_rows=50):
     import csv
-    rows = []
     try:
-        with open(path, "r", encoding="utf-8", errors="ignore") as f:
-            for i, row in enumerate(csv.reader(f)):
-                rows.append(", ".join(row))
-                if i >= max_rows: break
+        with open(path, "r", newline="", encoding="utf-8", errors="ignore") as f:
+            return "\n".join(", ".join(row) for row in islice(csv.reader(f), max_rows))
     except Exception:
         return ""
-    return "\n".join(rows)
 
-def read_pdf_preview(path, max_pages=5):
+def read_pdf_preview(path, max_pages=5, max_chars=12000, max_seconds=1.0):
     try:
-        from pypdf import PdfReader
-        reader = PdfReader(path)
-        texts = []
-        for page in reader.pages[:max_pages]:
-            texts.append(page.extract_text() or "")
+        import pymupdf
+        deadline = time.monotonic() + max_seconds   # budget for the whole document, checked between pages
+        texts, total = [], 0
+        with pymupdf.open(path) as doc:
+            for i in range(min(max_pages, doc.page_count)):
+                t = doc.load_page(i).get_text("text")
+                texts.append(t)
+                total += len(t)
+                if total >= max_chars: break   # caller only keeps ~12k chars anyway
+                if time.monotonic() > deadline: break   # slow document: keep the pages read so far
         return "\n\n".join(texts)
     except Exception:
         return ""
@@ -133,6 +328,87 @@ def read_docx_preview(path, max_chars=8000):
     except Exception:
         return ""
 
+def read_image_data_url(path, mime, chunk_size=3 * 256 * 1024):
+    # encode chunk by chunk (multiple of 3 => no padding mid-stream) so the raw
+    # file never sits in memory next to its base64 copy
+    buf = io.BytesIO()
+    buf.write(f"data:{mime};base64,".encode("ascii"))
+    with open(path, "rb") as f:
+        while chunk := f.read(chunk_size):
+            buf.write(base64.b64encode(chunk))
+    return buf.getvalue().decode("ascii")
+
+def save_upload(storage, ext, buffer_size=1024 * 1024):
+    """Stores an upload content-addressed as UPLOAD_DIR/<sha256><ext>; returns (path, size, sha256)."""
+    digest, size = hashlib.sha256(), 0
+    src = storage.stream
+    tmp_path = getattr(src, "name", None)
+    if tmp_path in request.__dict__.get("upload_parts", ()):
+        # already on disk next to its final place: hash it, no copy
+        src.seek(0)
+        while chunk := src.read(buffer_size):
+            digest.update(chunk)
+            size += len(chunk)
+        src.close()
+    else:
+        tmp_path = os.path.join(UPLOAD_DIR, f"{uuid.uuid4().hex}.part")
+        with open(tmp_path, "wb") as out:
+            while chunk := src.read(buffer_size):
+                digest.update(chunk)
+                out.write(chunk)
+                size += len(chunk)
+    sha = digest.hexdigest()
+    path = os.path.join(UPLOAD_DIR, f"{sha}{ext}")
+    if os.path.exists(path):
+        os.remove(tmp_path)          # same bytes already on disk: share the blob
+    else:
+        os.replace(tmp_path, path)
+    return path, size, sha
+
+def preview_kind(mime):
+    if mime.startswith("image/"): return "image"
+    if mime.startswith(TEXT_MIME_PREFIXES): return "File"
+    if mime in PDF_MIME: return "PDF"
+    if mime in DOC_MIME: return "DOCX"
+    if mime in CSV_MIME: return "CSV"
+    return None
+
+def preview_key(sha, mime):
+    # same bytes labelled text/plain and application/pdf get different previews
+    return sha, preview_kind(mime.lower())
+
+PREVIEW_READERS = {"File": read_text_file, "PDF": read_pdf_preview, "DOCX": read_docx_preview, "CSV": read_csv_preview}
+
+def read_preview(mime, path):
+    """Extracted text of a document ("" if unreadable); None for images and unknown types."""
+    reader = PREVIEW_READERS.get(preview_kind(mime))
+    return reader(path) if reader else None
+
+@lru_cache(maxsize=IMAGE_CACHE_SIZE)
+def cached_image_data_url(path, mime):
+    # blobs are content-addressed, so one entry serves every attachment of the same image
+    return read_image_data_url(path, mime)
+
+def extract_attachment(filename, mime, path, preview_text=None):
+    """Returns ("image", data_url), ("text", chunk) or None if nothing usable."""
+    kind = preview_kind(mime)
+    if kind == "image":
+        # pass image as data URL
+        try:
+            if os.path.getsize(path) > IMAGE_CACHE_MAX_BYTES:
+                return "image", read_image_data_url(path, mime)
+            return "image", cached_image_data_url(path, mime)
+        except Exception:
+            return None
+    if preview_text is None:
+        preview_text = read_preview(mime, path)   # rows uploaded before previews were stored
+    return ("text", f"# {kind}: {filename}\n{preview_text}") if preview_text else None
+
+@app.errorhandler(413)
+def upload_too_large(_e):
+    limit_mb = app.config["MAX_CONTENT_LENGTH"] // (1024 * 1024)
+    return jsonify({"error": f"Upload too large (max {limit_mb} MB)."}), 413
+
 # --- UI -----------------------------------------------------------------
 @app.get("/")
 def home():
@@ -141,14 +417,12 @@ def home():
 # --- Profile CRUD -------------------------------------------------------
 @app.get("/api/profile")
 def get_profile():
-    s = get_session()
-    prof = ensure_profile(s)
-    return jsonify({"id": prof.id, "name": prof.name, "timezone": prof.timezone, "tone": prof.tone, "notes": prof.notes})
+    return jsonify(cached_profile())
 
 @app.put("/api/profile")
 def update_profile():
-    s = get_session()
-    prof = ensure_profile(s)
+    s = db()
+    prof = ensure_profile()
     data = request.json or {}
     prof.name = data.get("name", prof.name)
     prof.timezone = data.get("timezone", prof.timezone)
@@ -158,51 +432,54 @@ def update_profile():
         return jsonify({"error": "Notes too long (max 500 chars)."}), 400
     prof.notes = notes
     s.commit()
+    profile_cache["v"] = None
     return jsonify({"ok": True})
 
 @app.delete("/api/profile")
 def delete_profile():
-    s = get_session()
-    prof = s.query(UserProfile).first()
-    if prof:
-        s.delete(prof)
-        s.commit()
+    # single-statement mutations go straight through Core: no session, identity map or flush
+    with engine.begin() as conn:
+        conn.execute(delete(UserProfile))
+    profile_ref["id"] = None
+    profile_cache["v"] = None
     return jsonify({"ok": True})
 
 # --- Conversations CRUD -------------------------------------------------
 @app.post("/api/conversations")
 def create_conversation():
-    s = get_session()
-    c = Conversation(title="New Conversation")
-    s.add(c)
-    s.commit()
-    return jsonify({"id": c.id, "title": c.title})
+    title = "New Conversation"
+    with engine.begin() as conn:
+        cid = conn.execute(insert(Conversation).values(title=title).returning(Conversation.id)).scalar_one()
+    return jsonify({"id": cid, "title": title})
 
 @app.get("/api/conversations")
 def list_conversations():
-    s = get_session()
-    convos = s.query(Conversation).order_by(Conversation.updated_at.desc()).all()
-    return jsonify([{"id": c.id, "title": c.title, "updated_at": c.updated_at.isoformat()} for c in convos])
+    s = db()
+    # lambda_stmt: the statement is built and cache-keyed once, not on every request
+    rows = s.execute(lambda_stmt(lambda: select(Conversation.id, Conversation.title, Conversation.updated_at)
+                                 .order_by(Conversation.updated_at.desc())))
+    return jsonify([{"id": cid, "title": title, "updated_at": updated_at} for cid, title, updated_at in rows])
 
 @app.delete("/api/conversations/<int:cid>")
 def delete_conversation(cid):
-    s = get_session()
-    c = s.query(Conversation).get(cid)
-    if not c:
-        return jsonify({"error": "Not found"}), 404
-    s.delete(c)
-    s.commit()
+    with engine.begin() as conn:
+        # Core doesn't run the ORM cascade: remove the messages in the same transaction
+        conn.execute(delete(Message).where(Message.conversation_id == cid))
+        if conn.execute(delete(Conversation).where(Conversation.id == cid)).rowcount == 0:
+            return jsonify({"error": "Not found"}), 404
     return jsonify({"ok": True})
 
 # --- Messages -----------------------------------------------------------
 @app.get("/api/messages/<int:cid>")
 def list_messages(cid):
-    s = get_session()
-    c = s.query(Conversation).get(cid)
-    if not c:
+    s = db()
+    if s.get(Conversation, cid) is None:
         return jsonify({"error": "Not found"}), 404
-    msgs = [{"id": m.id, "role": m.role, "content": m.content, "created_at": m.created_at.isoformat()} for m in c.messages]
-    return jsonify(msgs)
+    # plain rows, not Message instances: no identity map, no relationship bookkeeping
+    rows = s.execute(lambda_stmt(lambda: select(Message.id, Message.role, Message.content, Message.created_at)
+                                 .where(Message.conversation_id == cid).order_by(Message.id)))
+    return jsonify([{"id": mid, "role": role, "content": content, "created_at": created_at}
+                    for mid, role, content, created_at in rows])
 
 # --- Upload (multiple files) -------------------------------------------
 @app.post("/api/upload")
@@ -213,47 +490,144 @@ def upload_files():
       - files: one or more files (field name 'files')
     Returns: { conversation_id, attachments: [{id, filename, mime, size}] }
     """
-    s = get_session()
+    s = db()
 
     cid = request.form.get("conversation_id", type=int)
     if cid:
-        convo = s.query(Conversation).get(cid)
+        convo = s.get(Conversation, cid)
         if not convo:
             return jsonify({"error": "Conversation not found"}), 404
     else:
-        convo = Conversation(title="New Conversation")
-        s.add(convo)
-        s.flush()  # get convo.id
+        convo = Conversation(title="New Conversation")   # inserted by the single flush below
 
     files = request.files.getlist("files")
     if not files:
         return jsonify({"error": "No files uploaded"}), 400
 
-    saved = []
+    created = []
     for f in files:
         if not f or not f.filename:
             continue
         safe_name = secure_filename(f.filename)
         ext = os.path.splitext(safe_name)[1]
-        unique = f"{uuid.uuid4().hex}{ext}"
-        save_path = os.path.join(UPLOAD_DIR, unique)
-        f.save(save_path)
-        size = os.path.getsize(save_path)
+        save_path, size, sha = save_upload(f, ext)
         att = Attachment(
-            conversation_id=convo.id,
+            conversation=convo,
             filename=safe_name,
             mime=f.mimetype or "application/octet-stream",
             path=save_path,
             size=size,
+            sha256=sha,
         )
-        s.add(att)
-        s.flush()
-        saved.append({"id": att.id, "filename": att.filename, "mime": att.mime, "size": att.size})
-
+        created.append(att)
+
+    # parse documents once here so chat turns can reuse the stored text;
+    # content already uploaded before (any conversation) reuses its preview, if read by the same reader
+    rows = s.execute(select(Attachment.sha256, Attachment.mime, Attachment.preview_text).where(
+        Attachment.sha256.in_({att.sha256 for att in created}),
+        Attachment.preview_text.is_not(None))).all()
+    known = {preview_key(sha, mime): preview for sha, mime, preview in rows}
+    todo = list({preview_key(att.sha256, att.mime): att for att in created
+                 if preview_key(att.sha256, att.mime) not in known}.values())
+    # serial on purpose: PyMuPDF is not thread-safe and the docx/csv readers hold the GIL
+    previews = [read_preview(att.mime.lower(), att.path) for att in todo]
+    known.update((preview_key(att.sha256, att.mime), preview) for att, preview in zip(todo, previews))
+    for att in created:
+        att.preview_text = known.get(preview_key(att.sha256, att.mime))
+
+    # all writes at the end: the SQLite write lock isn't held while files are saved/parsed
     convo.updated_at = datetime.utcnow()
+    s.add_all([convo, *created])
+    s.flush()   # one flush for the conversation (if new) and every attachment id
+    saved = [{"id": att.id, "filename": att.filename, "mime": att.mime, "size": att.size} for att in created]
     s.commit()
     return jsonify({"conversation_id": convo.id, "attachments": saved})
 
+# --- Chat jobs ----------------------------------------------------------
+INTERRUPTED_NOTE = "\n\n*[reply interrupted]*"
+chat_workers = ThreadPoolExecutor(max_workers=int(os.getenv("CHAT_WORKERS", "8")), thread_name_prefix="chat")
+
+# Duplicate prompts: the same turn sent on top of the same stored context reuses its reply for a few
+# minutes. Once a reply is saved the context has changed, so a re-send or follow-up asks OpenAI again.
+CHAT_TEMPERATURE = 1
+REPLY_CACHE_TTL = float(os.getenv("REPLY_CACHE_TTL", "300"))   # seconds; 0 disables
+REPLY_CACHE_SIZE = 256
+reply_cache = {}   # reply_key() -> (expires_at, answer), oldest first
+reply_cache_lock = threading.Lock()
+
+def reply_key(cid, system_msg, history, turn):
+    # stored text only (attachments by id): no data URLs are serialized or hashed
+    context = [OPENAI_MODEL, CHAT_TEMPERATURE, cid, system_msg["content"], history, turn]
+    return hashlib.blake2b(orjson.dumps(context), digest_size=16).digest()
+
+def cached_reply(key):
+    hit = reply_cache.get(key)
+    return hit[1] if hit and hit[0] > time.monotonic() else None
+
+def remember_reply(key, answer):
+    if REPLY_CACHE_TTL <= 0:
+        return
+    now = time.monotonic()
+    with reply_cache_lock:
+        reply_cache.pop(key, None)   # re-insert at the end: keeps the dict in expiry order
+        while reply_cache and (len(reply_cache) >= REPLY_CACHE_SIZE or next(iter(reply_cache.values()))[0] <= now):
+            reply_cache.pop(next(iter(reply_cache)))
+        reply_cache[key] = (now + REPLY_CACHE_TTL, answer)
+
+def save_turn(cid, user_text, answer, new_title):
+    """Saves a user turn + reply (and the conversation metadata) in one commit; returns the conversation id."""
+    s = db()
+    convo = s.get(Conversation, cid) if cid else Conversation(title="New Conversation")
+    if convo is None:
+        return None   # deleted while the reply was generated
+    # one flush: SA 2.0 batches both rows into a single INSERT .. RETURNING
+    s.add_all([
+        Message(conversation=convo, role="user", content=user_text),
+        Message(conversation=convo, role="assistant", content=answer),
+    ])
+    if new_title:
+        convo.title = new_title   # the UPDATE bumps updated_at via onupdate
+        convo.title_set = True
+    else:
+        convo.updated_at = datetime.utcnow()   # message INSERTs alone leave the row untouched
+    s.commit()
+    return convo.id
+
+def run_chat_stream(events, api_messages, cid, user_text, new_title, key):
+    """Chat worker job: puts OpenAI deltas on `events`, saves the turn, then puts None."""
+    parts, error = [], None
+    try:
+        try:
+            stream = client.chat.completions.create(
+                model=OPENAI_MODEL,
+                messages=api_messages,
+                temperature=CHAT_TEMPERATURE,
+                stream=True,
+            )
+            for chunk in stream:
+                delta = chunk.choices[0].delta.content if chunk.choices else None
+                if delta:
+                    parts.append(delta)
+                    events.put({"delta": delta})
+        except Exception as e:
+            error = f"OpenAI error: {str(e)}"
+            if not parts:
+                events.put({"error": error})
+                return
+            parts.append(INTERRUPTED_NOTE)   # keep the part the user has already seen
+        else:
+            if key:
+                remember_reply(key, "".join(parts))   # complete replies only
+        try:
+            # once, after the last token (or the interruption)
+            convo_id = save_turn(cid, user_text, "".join(parts), new_title)
+            events.put({"error": error, "conversation_id": convo_id} if error else {"done": True, "conversation_id": convo_id})
+        except Exception as e:
+            events.put({"error": f"Could not save reply: {str(e)}"})
+    finally:
+        db.remove()   # worker threads are reused: drop this job's session
+        events.put(None)
+
 # --- Chat (text + attachments) -----------------------------------------
 @app.post("/api/chat")
 def chat():
@@ -262,10 +636,14 @@ def chat():
     {
       "conversation_id": <int|null>,
       "message": "User text",
-      "attachment_ids": [1,2,3]   # optional
+      "attachment_ids": [1,2,3],  # optional
+      "stream": true              # optional: reply as text/event-stream
     }
+    Streamed replies send `data: {"delta": "..."}` events, then
+    `data: {"done": true, "conversation_id": ...}` (or `data: {"error": "..."}`; when a reply
+    breaks off midway, the part already sent is saved and the error event carries conversation_id).
     """
-    s = get_session()
+    s = db()
     data = request.json or {}
     text = (data.get("message") or "").strip()
     attachment_ids = data.get("attachment_ids", [])
@@ -273,58 +651,54 @@ def chat():
     if not text and not attachment_ids:
         return jsonify({"error": "Empty message"}), 400
 
-    # Get or create conversation
+    # before any pending changes: ensure_profile() may commit
+    prof = cached_profile()
+
+    # Existing conversation, or None: save_turn() creates it with the first reply
     cid = data.get("conversation_id")
+    convo = None
     if cid:
-        convo = s.query(Conversation).get(cid)
+        convo = s.get(Conversation, cid)
         if not convo:
             return jsonify({"error": "Conversation not found"}), 404
-    else:
-        convo = Conversation(title="New Conversation")
-        s.add(convo)
-        s.flush()  # get convo.id
 
-    # Load attachments (if any)
+    # Load attachments (if any) -- a new conversation cannot own any yet
     attachments = []
-    if attachment_ids:
+    if attachment_ids and cid:
         attachments = s.query(Attachment).filter(
             Attachment.id.in_(attachment_ids),
-            Attachment.conversation_id == convo.id
+            Attachment.conversation_id == cid
         ).all()
 
-    # Persist user message (text only for now)
     user_text_to_store = text if text else "[attachment(s) uploaded]"
-    s.add(Message(conversation_id=convo.id, role="user", content=user_text_to_store))
-    s.commit()
 
-    # Build history for API call
-    history = [{"role": m.role, "content": m.content}
-               for m in s.query(Message).filter_by(conversation_id=convo.id).order_by(Message.id).all()]
+    # Build history for API call: latest stored turns (this turn is appended below)
+    history = []
+    if cid:
+        window = MAX_HISTORY_MESSAGES - 1   # cid and window become bound parameters of the cached lambda
+        rows = s.execute(lambda_stmt(lambda: select(Message.role, Message.content)
+                                     .where(Message.conversation_id == cid)
+                                     .order_by(Message.id.desc()).limit(window))).all()
+        history = [{"role": role, "content": content} for role, content in reversed(rows)]
+
+    # Default-titled conversation: turns are stored user-first, so history[0] is its first user turn
+    new_title = None
+    if convo is None or not convo.title_set:
+        new_title = title_from_text(history[0]["content"] if history else user_text_to_store)
 
     # Personalization
-    prof = ensure_profile(s)
-    profile_note = f"User name: {prof.name or 'User'}. Timezone: {prof.timezone or 'Europe/Athens'}. Tone: {prof.tone or 'professional'}."
-    if prof.notes:
-        profile_note += f" Extra notes: {prof.notes[:300]}"
-
-    system_msg = {
-        "role": "system",
-        "content": (
-            "You are a mentor-style assistant. Use Greek for prose and keep technical terms in English. "
-            "Write with clear structure using Markdown. Default to short paragraphs with whitespace. "
-            "Use bullet lists when enumerating, tables for comparisons when helpful, and fenced code blocks with language. "
-            "Prefer clarity over verbosity; add small headings if it aids scanning. "
-            "Preserve privacy; avoid storing sensitive data. "
-            "If you are not sure about something ask for more information."
-            "If the mini model that we use is not capable to solve or explain a problem you should tell me to switch to a more skillful model."
-            "Explain like you talk to human with explanations not just theory."
-            "Try to put a tone of humor in your responses."
-            "Try to notice best practices✅, acceptable but not the perfect thing⚠️, and avoid to do❌."
-            "Use emojis for more fun conversations."
-            "Keep answers within 3–5 short paragraphs unless explicitly asked for more."
-            + profile_note
-        )
-    }
+    system_msg = system_message(prof["name"], prof["timezone"], prof["tone"], prof["notes"])
+
+    # Same turn on the same context (this conversation only): reuse the reply, skip OpenAI and attachment work
+    turn = [user_text_to_store, sorted(att.id for att in attachments)]
+    key = reply_key(cid, system_msg, history, turn) if cid else None
+    answer = cached_reply(key) if key else None
+    if answer is not None:
+        convo_id = save_turn(cid, user_text_to_store, answer, new_title)
+        if data.get("stream"):
+            return Response([sse_event({"delta": answer}), sse_event({"done": True, "conversation_id": convo_id})],
+                            mimetype="text/event-stream", headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+        return jsonify({"conversation_id": convo_id, "reply": answer})
 
     # Build multimodal user turn from attachments
     user_parts = []
@@ -332,66 +706,63 @@ def chat():
         user_parts.append({"type": "text", "text": text})
 
     extracted_chunks = []
-    for att in attachments:
-        mime = (att.mime or "").lower()
-        if mime.startswith("image/"):
-            # pass image as data URL
-            try:
-                with open(att.path, "rb") as f:
-                    b64 = base64.b64encode(f.read()).decode("utf-8")
-                data_url = f"data:{mime};base64,{b64}"
-                user_parts.append({"type": "image_url", "image_url": {"url": data_url}})
-            except Exception:
-                pass
-        elif mime.startswith(TEXT_MIME_PREFIXES):
-            t = read_text_file(att.path)
-            if t: extracted_chunks.append(f"# File: {att.filename}\n{t}")
-        elif mime in PDF_MIME:
-            t = read_pdf_preview(att.path)
-            if t: extracted_chunks.append(f"# PDF: {att.filename}\n{t}")
-        elif mime in DOC_MIME:
-            t = read_docx_preview(att.path)
-            if t: extracted_chunks.append(f"# DOCX: {att.filename}\n{t}")
-        elif mime in CSV_MIME:
-            t = read_csv_preview(att.path)
-            if t: extracted_chunks.append(f"# CSV: {att.filename}\n{t}")
+    extracted = (extract_attachment(att.filename, (att.mime or "").lower(), att.path, att.preview_text) for att in attachments)
+    for kind, value in filter(None, extracted):
+        if kind == "image":
+            user_parts.append({"type": "image_url", "image_url": {"url": value}})
+        else:
+            extracted_chunks.append(value)
 
     if extracted_chunks:
         joined = "\n\n---\n\n".join(extracted_chunks)
         user_parts.append({"type": "text", "text": f"Attached file excerpts:\n\n{joined[:12000]}"})
 
-    api_messages = [system_msg] + history
-    if user_parts:
-        if api_messages and api_messages[-1]["role"] == "user":
-            api_messages.pop()
-        api_messages.append({"role": "user", "content": user_parts})
+    # this turn goes in once: multimodal parts if any, else its stored text
+    history = trim_history(history, MAX_HISTORY_TOKENS)
+    api_messages = [system_msg, *history, {"role": "user", "content": user_parts or user_text_to_store}]
+
+    # Nothing pending: end the read transaction so the pooled connection (and its
+    # WAL snapshot) is free for other requests while we wait on OpenAI
+    s.rollback()
+
+    if data.get("stream"):
+        # generation runs on a chat worker, not this request: a closed tab still gets its reply saved
+        events = queue.Queue()
+        chat_workers.submit(run_chat_stream, events, api_messages, cid, user_text_to_store, new_title, key)
+
+        def stream():
+            while (event := events.get()) is not None:
+                yield sse_event(event)
+
+        return Response(stream(), mimetype="text/event-stream",
+                        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
 
     # OpenAI call
     try:
         resp = client.chat.completions.create(
             model=OPENAI_MODEL,
             messages=api_messages,
-            temperature=1,
+            temperature=CHAT_TEMPERATURE,
         )
         answer = resp.choices[0].message.content
     except Exception as e:
         return jsonify({"error": f"OpenAI error: {str(e)}"}), 500
 
-    # Save assistant message
-    s.add(Message(conversation_id=convo.id, role="assistant", content=answer))
-
-    if convo.title == "New Conversation":
-        convo.title = title_from_first_user_message(history) or "New Conversation"
-
-    convo.updated_at = datetime.utcnow()
-    s.commit()
-
-    return jsonify({"conversation_id": convo.id, "reply": answer})
+    if key and answer is not None:
+        remember_reply(key, answer)
+    return jsonify({"conversation_id": save_turn(cid, user_text_to_store, answer, new_title), "reply": answer})
 
 # --- Main ---------------------------------------------------------------
 if __name__ == "__main__":
-    import threading, webbrowser
+    import webbrowser
+    init_db()   # desktop launch: single process, keep the DB ready without a separate step
     def open_browser():
         webbrowser.open_new("http://127.0.0.1:5000")
     threading.Timer(1.0, open_browser).start()
-    app.run(host="127.0.0.1", port=5000, debug=False)
+    try:
+        from waitress import serve
+    except ImportError:
+        app.run(host="127.0.0.1", port=5000, debug=False)
+    else:
+        # production WSGI server that also runs on Windows; streams SSE unbuffered
+        serve(app, host="127.0.0.1", port=5000, threads=int(os.getenv("SERVER_THREADS", "16")))
@@ -1,6 +1,7 @@
 // static/js/app.js
 // Client for Flask API: conversations, messages, chat (text + attachments), profile.
 // Uses Markdown (marked + DOMPurify). Supports multi-pick uploads queued before Send.
+// Chat replies are streamed (SSE over fetch) and rendered as tokens arrive.
 
 const el = {
   conversations: document.getElementById("conversations"),
@@ -28,6 +29,25 @@ async function jpost(url, body) {
   const r = await fetch(url, { method: "POST", headers: { "Content-Type": "application/json" }, body: JSON.stringify(body) });
   if (!r.ok) throw new Error(await r.text()); return r.json();
 }
+// POST JSON, read a text/event-stream reply; calls onEvent(obj) per `data:` event
+async function jstream(url, body, onEvent) {
+  const r = await fetch(url, { method: "POST", headers: { "Content-Type": "application/json" }, body: JSON.stringify(body) });
+  if (!r.ok) throw new Error(await r.text());
+  const reader = r.body.getReader();
+  const decoder = new TextDecoder();
+  let buf = "";
+  for (;;) {
+    const { value, done } = await reader.read();
+    if (done) break;
+    buf += decoder.decode(value, { stream: true });
+    let sep;
+    while ((sep = buf.indexOf("\n\n")) !== -1) {
+      const line = buf.slice(0, sep).trim();
+      buf = buf.slice(sep + 2);
+      if (line.startsWith("data:")) onEvent(JSON.parse(line.slice(5)));
+    }
+  }
+}
 async function jput(url, body) {
   const r = await fetch(url, { method: "PUT", headers: { "Content-Type": "application/json" }, body: JSON.stringify(body) });
   if (!r.ok) throw new Error(await r.text()); return r.json();
@@ -221,20 +241,38 @@ async function sendMessage() {
   el.input.disabled = true;
   el.send.disabled = true;
 
+  // assistant bubble filled in as tokens stream in
+  const botDiv = document.createElement("div");
+  botDiv.className = "msg assistant";
+  botDiv.innerHTML = `<div class="text"></div><span class="meta">now</span>`;
+  const botText = botDiv.querySelector(".text");
+  let reply = "", frame = 0;
+  const render = () => {
+    frame = 0;
+    botText.innerHTML = DOMPurify.sanitize(marked.parse(reply));
+    el.messages.scrollTop = el.messages.scrollHeight;
+  };
+
   try {
-    const res = await jpost("/api/chat", {
+    el.messages.appendChild(botDiv);
+    await jstream("/api/chat", {
       conversation_id: state.activeId,
       message: text,
-      attachment_ids: attachmentIds
+      attachment_ids: attachmentIds,
+      stream: true
+    }, (ev) => {
+      if (ev.conversation_id) state.activeId = ev.conversation_id;  // also sent with a partial reply's error
+      if (ev.error) throw new Error(ev.error);
+      if (ev.delta) {
+        reply += ev.delta;
+        if (!frame) frame = requestAnimationFrame(render);  // at most one re-render per frame
+      }
     });
-    const botDiv = document.createElement("div");
-    botDiv.className = "msg assistant";
-    const botHtml = DOMPurify.sanitize(marked.parse(res.reply || ""));
-    botDiv.innerHTML = `<div class="text">${botHtml}</div><span class="meta">now</span>`;
-    el.messages.appendChild(botDiv);
-    el.messages.scrollTop = el.messages.scrollHeight;
+    if (frame) cancelAnimationFrame(frame);
+    render();
     await loadConversations();
   } catch (e) {
+    if (!reply) botDiv.remove();
     alert("Chat error: " + e.message);
   } finally {
     el.input.disabled = false;